@@ -2,10 +2,36 @@
 
 import argparse
 import gzip
+import os
+import queue
+import shutil
+import struct
 import sys
 import subprocess
+import threading
+import zlib
+from collections import deque
+from contextlib import closing, suppress
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from Bio import SeqIO
+
+try:
+    from isal import igzip, isal_zlib
+except ImportError:  # optional: fall back to stdlib gzip and the bgzip binary
+    igzip = isal_zlib = None
+
+CHUNK_SIZE = 1024 * 1024  # bytes read per input block
+IO_BUFFER_SIZE = 4 * 1024 * 1024  # file buffers: far fewer read()/write() syscalls than the 8 KiB default
+PIPELINE_DEPTH = 4  # blocks buffered between read, rewrite and write stages
+# posix_fadvise hints are Linux/BSD only
+FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", None)
+FADV_WILLNEED = getattr(os, "POSIX_FADV_WILLNEED", None)
+# More than ~4 compression threads buys little and competes with the rewriter
+DEFAULT_THREADS = min(4, os.cpu_count() or 1)
+BGZF_BLOCK_SIZE = 0xFF00  # uncompressed bytes per BGZF block, as in htslib
+# gzip member header with the BGZF 'BC' extra subfield; BSIZE follows
+BGZF_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
 
 def read_genome_list(file_path):
     """Read input list with: SAMPLE_NAME path/to/file.fasta"""
@@ -18,91 +44,732 @@ def read_genome_list(file_path):
                 genomes.append((name, fasta_path))
     return genomes
 
-def load_checkpoint(path: Path):
+def load_checkpoint(path: Path, errlog=None, max_malformed=5):
+    """Return (completed sample names as a set of bytes, output size at the last checkpoint).
+
+    Each line is "SAMPLE<TAB>OUTPUT_SIZE"; bare sample names from older runs
+    are accepted too. The size is None if no line records one, and 0 if
+    nothing has been checkpointed yet. Other lines are reported to errlog,
+    and more than max_malformed of them aborts the run instead of silently
+    reprocessing samples.
+    """
     if not path.exists():
-        return set()
-    with open(path, "r") as f:
-        done = {line.strip() for line in f if line.strip()}
-    return done
-
-def append_checkpoint(path: Path, sample_name: str):
-    with open(path, "a") as f:
-        f.write(sample_name + "\n")
-
-def log_error(errlog: Path, sample_name: str, fasta_path: Path, exc: Exception):
-    errlog.parent.mkdir(parents=True, exist_ok=True)
-    with open(errlog, "a") as f:
-        f.write(f"[ERROR] sample={sample_name} file={fasta_path} error={repr(exc)}\n")
-
-def open_fasta_auto(p: Path):
-    if p.suffix == ".gz":
-        return gzip.open(p, "rt")
-    return open(p, "r")
-
-def process_one_genome(sample_name, fasta_path, out_handle, scaffold_map_dir: Path, delim="#", haplo_id="1"):
+        return set(), 0
+    data = path.read_bytes()
+    # Fast path for old checkpoints: a bare split() drops blank lines and stray '\r'
+    if b" " not in data and b"\t" not in data:
+        done = set(data.split())
+        return done, (None if done else 0)
+
+    done = set()
+    last_size = None
+    malformed = 0
+    for lineno, line in enumerate(data.splitlines(), 1):
+        parts = line.split()
+        if len(parts) == 1:
+            done.add(parts[0])
+        elif len(parts) == 2 and parts[1].isdigit():
+            done.add(parts[0])
+            last_size = int(parts[1])
+        elif parts:
+            malformed += 1
+            if errlog is not None:
+                errlog.log(f"[ERROR] checkpoint={path} line={lineno} malformed={line.decode(errors='replace')!r}")
+    if malformed > max_malformed:
+        raise ValueError(f"Checkpoint {path} has {malformed} malformed lines (limit {max_malformed}); fix it or use --reset")
+    if malformed:
+        print(f"[WARN] Ignored {malformed} malformed checkpoint lines in {path}; affected samples will be reprocessed.")
+    return done, (0 if last_size is None and not done else last_size)
+
+class Checkpoint:
+    """Checkpoint file kept open for the whole run; each sample is synced to disk as it completes.
+
+    Alongside each sample it records the output size once that sample is on
+    disk, so a resumed run can cut off anything written after it.
+    """
+
+    def __init__(self, path: Path):
+        self.handle = open(path, "a")
+
+    def add(self, sample_name: str, output_size: int):
+        self.handle.write(f"{sample_name}\t{output_size}\n")
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ErrorLog:
+    """Append-mode error log, opened on the first error and kept open for the run.
+
+    Only the main process writes to it; worker failures arrive through their futures.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.handle = None
+
+    def log(self, message: str):
+        if self.handle is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.handle = open(self.path, "a")
+        self.handle.write(message + "\n")
+        self.handle.flush()
+
+    def error(self, sample_name: str, fasta_path: Path, exc: Exception):
+        self.log(f"[ERROR] sample={sample_name} file={fasta_path} error={repr(exc)}")
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_fasta_auto(p: Path, threads=DEFAULT_THREADS):
+    """Open a FASTA for binary reading, picking the decoder from its magic bytes.
+
+    threads caps the inflate threads used for BGZF inputs.
+    """
+    with open(p, "rb") as f:
+        magic = f.read(18)
+    if magic[:2] == b"\x1f\x8b":
+        # BGZF: gzip with FEXTRA and a 'BC' subfield; its blocks inflate independently
+        if isal_zlib is not None and magic[3] & 0x04 and magic[12:14] == b"BC":
+            handle = BgzfReader(p, threads=threads)
+        else:
+            # ISA-L inflate is several times faster than stdlib zlib
+            handle = (igzip or gzip).open(p, "rb")
+    else:
+        handle = open(p, "rb", buffering=IO_BUFFER_SIZE)
+    fadvise(handle.fileno(), FADV_SEQUENTIAL)  # larger kernel read-ahead
+    return handle
+
+def fadvise(fd, advice):
+    """Best-effort posix_fadvise over a whole file; a no-op where unsupported."""
+    if advice is None:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, advice)
+    except OSError:
+        pass
+
+def prefetch_file(p):
+    """Ask the kernel to start reading p into the page cache before we need it."""
+    if FADV_WILLNEED is None:
+        return
+    try:
+        fd = os.open(p, os.O_RDONLY)
+    except OSError:
+        return  # a missing file is reported when it is actually processed
+    try:
+        fadvise(fd, FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+def read_blocks_in_thread(handle, depth=PIPELINE_DEPTH):
+    """Yield CHUNK_SIZE blocks read (and decompressed) by a background thread.
+
+    A bounded queue lets reading overlap with header rewriting; None marks EOF.
+    """
+    blocks = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            while not stop.is_set():
+                chunk = handle.read1(CHUNK_SIZE)
+                if not chunk:
+                    break
+                blocks.put(chunk)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            blocks.put(None)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while (chunk := blocks.get()) is not None:
+            yield chunk
+        if errors:
+            raise errors[0]
+    finally:
+        # Unblock the reader if we stopped early, before the handle is closed
+        stop.set()
+        while thread.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def write_blocks_in_thread(out_handle, chunks, depth=PIPELINE_DEPTH):
+    """Drain chunks into out_handle from a background writer thread."""
+    pending = queue.Queue(maxsize=depth)
+    errors = []
+
+    def writer():
+        while (chunk := pending.get()) is not None:
+            if not errors:  # keep draining after a failure so put() never blocks
+                try:
+                    out_handle.write(chunk)
+                except Exception as e:
+                    errors.append(e)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    try:
+        for chunk in chunks:
+            if errors:
+                break
+            pending.put(chunk)
+    finally:
+        pending.put(None)
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def rewrite_header(line, map_entries, prefix):
+    """Return '>SAMPLE#HAPLO#ID' for one header line and record the rename in map_entries."""
+    parts = line.split(None, 1)
+    orig_id = parts[0] if parts else b""
+    new_id = prefix + orig_id
+    map_entries.append(orig_id + b"\t" + new_id + b"\n")
+    return b">" + new_id + b"\n"
+
+def rewrite_fasta_stream(blocks, map_entries, sample_name, delim="#", haplo_id="1"):
+    """Yield FASTA bytes per input block, rewriting only the '>' header lines.
+
+    Sequence lines are passed through verbatim; a carry buffer keeps header
+    lines split across block boundaries intact.
+    """
+    # 'SAMPLE#HAPLO#' is constant for the genome, so build it once
+    prefix = f"{sample_name}{delim}{haplo_id}{delim}".encode()
+    carry = b""
+    at_line_start = True
+    for chunk in blocks:
+        buf = carry + chunk if carry else chunk
+        carry = b""
+        out = []
+        pos, end = 0, len(buf)
+        while pos < end:
+            if at_line_start and buf[pos] == 0x3E:  # b">"
+                eol = buf.find(b"\n", pos)
+                if eol == -1:
+                    carry = buf[pos:]
+                    break
+                out.append(rewrite_header(buf[pos + 1:eol], map_entries, prefix))
+                pos = eol + 1
+                continue
+            # Everything up to the next header line is copied untouched
+            nxt = buf.find(b"\n>", pos)
+            if nxt == -1:
+                out.append(buf[pos:])
+                at_line_start = buf[-1] == 0x0A  # b"\n"
+                break
+            out.append(buf[pos:nxt + 1])
+            pos = nxt + 1
+            at_line_start = True
+        if out:
+            yield b"".join(out)
+    if carry:  # last header without a trailing newline
+        yield rewrite_header(carry[1:], map_entries, prefix)
+
+def process_one_genome(sample_name, fasta_path, out_handle, scaffold_map_dir: Path, delim="#", haplo_id="1", threads=DEFAULT_THREADS):
     """Process a single genome: rewrite headers -> write to out_handle; create scaffold map."""
     fasta_path = Path(fasta_path)
     # Write scaffold map file name (use base without .fasta if present)
     base_name = fasta_path.stem
     if base_name.endswith(".fasta"):  # handle .fasta.gz
         base_name = base_name[:-6]
-    scaffold_map_dir.mkdir(parents=True, exist_ok=True)
     scaffold_map_path = scaffold_map_dir / f"{base_name}.txt"
 
     # Write to a temp map first; rename on success for atomicity
     tmp_map = scaffold_map_path.with_suffix(scaffold_map_path.suffix + ".tmp")
 
-    with open(tmp_map, "w") as map_handle:
-        with open_fasta_auto(fasta_path) as handle:
-            for record in SeqIO.parse(handle, "fasta"):
-                new_id = f"{sample_name}{delim}{haplo_id}{delim}{record.id}"
-                map_handle.write(f"{record.id}\t{new_id}\n")
-                record.id = new_id
-                record.description = ""
-                SeqIO.write(record, out_handle, "fasta")
+    # Read/decompress, rewrite and write/compress run as overlapping stages
+    map_entries = []
+    with open_fasta_auto(fasta_path, threads) as handle:
+        with closing(read_blocks_in_thread(handle)) as blocks:
+            rewritten = rewrite_fasta_stream(blocks, map_entries, sample_name, delim, haplo_id)
+            write_blocks_in_thread(out_handle, rewritten)
+    with open(tmp_map, "wb") as map_handle:
+        map_handle.write(b"".join(map_entries))
 
     tmp_map.rename(scaffold_map_path)  # atomic replace
     return scaffold_map_path
 
+def process_one_genome_to_shard(sample_name, fasta_path, shard_path: Path, scaffold_map_dir: Path, delim="#", haplo_id="1", threads=1, compresslevel=1):
+    """Worker: process a single genome into its own bgzipped shard file."""
+    with open_bgzf_output(shard_path, threads=threads, compresslevel=compresslevel) as out_handle:
+        return process_one_genome(sample_name, fasta_path, out_handle, scaffold_map_dir, delim, haplo_id, threads)
+
 def rewrite_headers_and_concat_with_checkpoints(
-    genomes, temp_output: Path, scaffold_map_dir: Path, ckpt_path: Path,
-    errlog_path: Path, delim="#", haplo_id="1"
+    genomes, output_path: Path, scaffold_map_dir: Path, ckpt_path: Path,
+    errlog: ErrorLog, delim="#", haplo_id="1", threads=DEFAULT_THREADS, workers=1, compresslevel=1,
+    gzi_path: Path = None, max_bad_checkpoint_lines=5
 ):
-    """Rewrite headers + concatenate, skipping items in checkpoint; log errors and continue."""
-    done = load_checkpoint(ckpt_path)
-    total = len(genomes)
-    to_do = [(s, p) for (s, p) in genomes if s not in done]
+    """Rewrite headers + concatenate, skipping items in checkpoint; log errors and continue.
 
-    if not temp_output.exists():
-        # Start new file
-        mode = "w"
-    else:
-        # Append if resuming
-        mode = "a"
+    If gzi_path is given, a bgzip .gzi index of the whole output is written there.
+    """
+    done, last_size = load_checkpoint(ckpt_path, errlog, max_bad_checkpoint_lines)
+    total = len(genomes)
+    to_do = [(s, p) for (s, p) in genomes if s.encode() not in done]
+    # Append if resuming, after dropping whatever an interrupted run wrote past its last checkpoint
+    append = output_path.exists()
+    if append and last_size is None:
+        # Old checkpoint without sizes: the best we can do is drop a torn final block
+        truncate_torn_bgzf(output_path)
+    elif append:
+        truncate_to_checkpoint(output_path, last_size)
+        append = last_size > 0
+    scaffold_map_dir.mkdir(parents=True, exist_ok=True)
 
     print(f"[INFO] Genomes total: {total} | Completed (checkpoint): {len(done)} | Remaining: {len(to_do)}")
-    failures = 0
+    with Checkpoint(ckpt_path) as checkpoint:
+        if workers > 1:
+            return concat_parallel(to_do, output_path, append, scaffold_map_dir, checkpoint, errlog, delim, haplo_id, workers, threads, compresslevel, gzi_path)
+        return concat_serial(to_do, output_path, append, scaffold_map_dir, checkpoint, errlog, delim, haplo_id, threads, compresslevel, gzi_path)
 
-    with open(temp_output, mode) as out_handle:
+def concat_serial(
+    to_do, output_path: Path, append, scaffold_map_dir: Path, checkpoint: Checkpoint,
+    errlog: ErrorLog, delim="#", haplo_id="1", threads=DEFAULT_THREADS, compresslevel=1, gzi_path: Path = None
+):
+    """Stream genomes one after another into a single BGZF writer."""
+    failures = 0
+    backend = "ISA-L" if isal_zlib is not None else "bgzip"
+    print(f"[BGZIP] Streaming into {output_path} with {threads} threads ({backend})...")
+    with open_bgzf_output(output_path, threads=threads, compresslevel=compresslevel, append=append, gzi_path=gzi_path) as out_handle:
         for i, (sample_name, fasta_path) in enumerate(to_do, 1):
             print(f"[READ {i}/{len(to_do)}] {sample_name}: {fasta_path}")
+            if i < len(to_do):
+                # Let the next genome's disk reads overlap with this one
+                prefetch_file(to_do[i][1])
             try:
-                map_path = process_one_genome(sample_name, fasta_path, out_handle, scaffold_map_dir, delim, haplo_id)
-                append_checkpoint(ckpt_path, sample_name)
+                map_path = process_one_genome(sample_name, fasta_path, out_handle, scaffold_map_dir, delim, haplo_id, threads)
+                # The genome must be on disk before the checkpoint says it is done
+                out_handle.flush()
+                checkpoint.add(sample_name, output_path.stat().st_size)
                 print(f"[WRITE] Scaffold map saved: {map_path} | Checkpointed: {sample_name}")
             except Exception as e:
+                # Drop whatever this genome wrote, so a partial record never reaches the output
+                out_handle.rollback()
+                failures += 1
+                errlog.error(sample_name, Path(fasta_path), e)
+                print(f"[WARN] Failed {sample_name}; logged and continuing.")
+
+    if gzi_path is not None and isal_zlib is None:
+        # Index from block headers: bgzip -i would only cover the appended part on resume
+        write_gzi(gzi_path, iter_bgzf_blocks(output_path))
+    return failures
+
+def concat_parallel(
+    to_do, output_path: Path, append, scaffold_map_dir: Path, checkpoint: Checkpoint,
+    errlog: ErrorLog, delim="#", haplo_id="1", workers=2, threads=DEFAULT_THREADS, compresslevel=1, gzi_path: Path = None
+):
+    """Rewrite genomes into per-genome BGZF shards on a process pool, then append them in input order.
+
+    A sample is checkpointed only once its shard has been copied into the output,
+    so an interrupted run never skips genomes on resume.
+    """
+    shard_dir = output_path.parent / (output_path.name + ".shards")
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    failures = 0
+    # Split the compression/inflate threads between workers instead of oversubscribing
+    shard_threads = max(1, threads // workers)
+
+    print(f"[INFO] Processing with {workers} workers x {shard_threads} compression threads; shards in {shard_dir}")
+    # No O_APPEND: Linux sendfile() rejects such targets with EINVAL, so seek to the end instead
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(output_path, "r+b" if append else "wb", buffering=0) as out_file:
+        committed = out_file.seek(0, os.SEEK_END)
+        appended = False
+        # Keep only ~2 shards per worker in flight so a slow genome cannot pile finished shards up on disk
+        queued = iter(enumerate(to_do))
+        in_flight = deque()
+
+        def submit_next():
+            item = next(queued, None)
+            if item is None:
+                return
+            j, (sample_name, fasta_path) = item
+            shard_path = shard_dir / f"{j}.fasta.gz"
+            in_flight.append((sample_name, fasta_path, shard_path, pool.submit(
+                process_one_genome_to_shard, sample_name, fasta_path, shard_path, scaffold_map_dir, delim, haplo_id, shard_threads, compresslevel
+            )))
+
+        for _ in range(2 * workers):
+            submit_next()
+
+        i = 0
+        while in_flight:
+            sample_name, fasta_path, shard_path, future = in_flight.popleft()
+            submit_next()
+            i += 1
+            try:
+                map_path = future.result()
+                # BGZF shards concatenate validly at the byte level
+                append_file(shard_path, out_file)
+                appended = True
+                # The shard must be on disk before the checkpoint says it is done
+                os.fsync(out_file.fileno())
+                committed = out_file.tell()
+                checkpoint.add(sample_name, committed)
+                print(f"[WRITE {i}/{len(to_do)}] {sample_name}: scaffold map saved: {map_path} | Checkpointed: {sample_name}")
+            except Exception as e:
+                # Cut off a partially copied shard
+                out_file.truncate(committed)
+                out_file.seek(committed)
                 failures += 1
-                log_error(errlog_path, sample_name, Path(fasta_path), e)
+                errlog.error(sample_name, Path(fasta_path), e)
                 print(f"[WARN] Failed {sample_name}; logged and continuing.")
+            finally:
+                shard_path.unlink(missing_ok=True)
+
+        if not append and not appended:
+            # Every genome failed: still leave a valid, empty BGZF file like the serial path
+            out_file.write(BGZF_EOF)
 
-    print(f"[WRITE] Temporary FASTA written/appended: {temp_output}")
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    if gzi_path is not None:
+        write_gzi(gzi_path, iter_bgzf_blocks(output_path))
     return failures
 
-def bgzip_file(input_path, threads=4):
-    """Compress the file using bgzip"""
-    print(f"[BGZIP] Compressing {input_path} with {threads} threads...")
-    subprocess.run(["bgzip", "-f", "-@", str(threads), str(input_path)], check=True)
-    print(f"[DONE] Compressed to: {input_path}.gz")
+def append_file(src_path: Path, out_file):
+    """Append src_path to out_file byte-for-byte, inside the kernel when sendfile allows it."""
+    out_file.flush()
+    with open(src_path, "rb") as src:
+        offset = 0
+        remaining = os.fstat(src.fileno()).st_size
+        try:
+            while remaining > 0:
+                sent = os.sendfile(out_file.fileno(), src.fileno(), offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+        except (AttributeError, OSError):
+            # No os.sendfile, or the platform cannot sendfile() into a regular file
+            src.seek(offset)
+            while chunk := src.read(IO_BUFFER_SIZE):
+                # out_file is unbuffered, so a single write() may take only part of the chunk
+                view = memoryview(chunk)
+                while view:
+                    view = view[out_file.write(view):]
+            out_file.flush()
+
+class BgzfReader:
+    """Read a BGZF file, inflating its independent blocks on a thread pool.
+
+    Only read1() is provided, which is all the rewriter needs.
+    """
+
+    def __init__(self, input_path: Path, threads=DEFAULT_THREADS):
+        self.handle = open(input_path, "rb", buffering=IO_BUFFER_SIZE)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.pending = deque()
+        self.max_pending = 4 * max(1, threads)
+        self.eof = False
+
+    def next_block(self):
+        """Return (deflate payload, CRC32/ISIZE footer) of the next block, or None at EOF."""
+        header = self.handle.read(12)
+        if not header:
+            return None
+        xlen = struct.unpack_from("<H", header, 10)[0] if len(header) == 12 else 0
+        extra = self.handle.read(xlen)
+        bsize = None
+        pos = 0
+        while pos + 4 <= len(extra):
+            slen = struct.unpack_from("<H", extra, pos + 2)[0]
+            if extra[pos:pos + 2] == b"BC" and slen == 2:
+                bsize = struct.unpack_from("<H", extra, pos + 4)[0] + 1
+            pos += 4 + slen
+        if header[:4] != b"\x1f\x8b\x08\x04" or bsize is None:
+            raise ValueError(f"Not a BGZF block at offset {self.handle.tell() - 12 - xlen}")
+        body = self.handle.read(bsize - 12 - xlen)
+        return body[:-8], body[-8:]
+
+    @staticmethod
+    def inflate_block(cdata, footer):
+        """Inflate one block and check it against its CRC32 and ISIZE footer."""
+        data = isal_zlib.decompress(cdata, -15)  # raw deflate: no integrity check of its own
+        crc, isize = struct.unpack("<II", footer)
+        if isal_zlib.crc32(data) != crc or len(data) & 0xFFFFFFFF != isize:
+            raise ValueError("BGZF block failed its CRC32/size check; input is corrupt")
+        return data
+
+    def fill(self):
+        while not self.eof and len(self.pending) < self.max_pending:
+            block = self.next_block()
+            if block is None:
+                self.eof = True
+            else:
+                self.pending.append(self.pool.submit(self.inflate_block, *block))
+
+    def read1(self, size=-1):
+        out = []
+        total = 0
+        while size < 0 or total < size:
+            self.fill()
+            if not self.pending:
+                break
+            block = self.pending.popleft().result()
+            out.append(block)
+            total += len(block)
+        return b"".join(out)
+
+    def fileno(self):
+        return self.handle.fileno()
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pool.shutdown()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class BgzfWriter:
+    """In-process BGZF writer backed by ISA-L deflate.
+
+    Blocks are compressed on a thread pool and written in order, producing the
+    same indexable framing as bgzip without forking it.
+    """
+
+    def __init__(self, output_path: Path, threads=DEFAULT_THREADS, compresslevel=1, append=False, gzi_path: Path = None):
+        self.level = min(compresslevel, isal_zlib.ISAL_BEST_COMPRESSION)
+        # Block offsets for the .gzi index, continuing from the existing blocks when appending
+        self.gzi_path = gzi_path
+        self.blocks = list(iter_bgzf_blocks(output_path)) if gzi_path is not None and append else []
+        self.coffset = output_path.stat().st_size if append else 0
+        self.uoffset = 0
+        if self.blocks:
+            _, last_u, last_isize = self.blocks[-1]
+            self.uoffset = last_u + last_isize
+        # State as of the last flush(), restored by rollback()
+        self.flushed = (self.coffset, self.uoffset, len(self.blocks))
+        self.handle = open(output_path, "ab" if append else "wb", buffering=IO_BUFFER_SIZE)
+        self.pool = ThreadPoolExecutor(max_workers=max(1, threads))
+        self.pending = deque()
+        self.max_pending = 2 * max(1, threads)
+        self.buffer = bytearray()
+
+    def compress_block(self, block):
+        cdata = isal_zlib.compress(block, self.level, -15)  # raw deflate
+        if len(BGZF_HEADER) + 2 + len(cdata) + 8 > 65536:
+            # ISA-L level 0 can expand incompressible data past the 64 KiB BSIZE limit; a stored block never does
+            cdata = zlib.compress(block, 0, -15)
+        header = BGZF_HEADER + struct.pack("<H", len(BGZF_HEADER) + 2 + len(cdata) + 8 - 1)
+        return header + cdata + struct.pack("<II", isal_zlib.crc32(block), len(block))
+
+    def submit(self, block):
+        self.pending.append((self.pool.submit(self.compress_block, block), len(block)))
+        while len(self.pending) > self.max_pending:
+            self.write_next()
+
+    def write_next(self):
+        future, isize = self.pending.popleft()
+        data = future.result()
+        self.handle.write(data)
+        if self.gzi_path is not None:
+            self.blocks.append((self.coffset, self.uoffset, isize))
+        self.coffset += len(data)
+        self.uoffset += isize
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= BGZF_BLOCK_SIZE:
+            view = memoryview(self.buffer)
+            full = len(view) - len(view) % BGZF_BLOCK_SIZE
+            for start in range(0, full, BGZF_BLOCK_SIZE):
+                self.submit(bytes(view[start:start + BGZF_BLOCK_SIZE]))
+            view.release()
+            del self.buffer[:full]
+
+    def flush(self):
+        """Compress the partial block, write everything pending and fsync it."""
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.write_next()
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.flushed = (self.coffset, self.uoffset, len(self.blocks))
+
+    def rollback(self):
+        """Discard everything written since the last flush(), truncating the file back to it."""
+        while self.pending:
+            future, _ = self.pending.popleft()
+            future.exception()  # wait: the block must not land after the truncate
+        self.buffer.clear()
+        self.coffset, self.uoffset, nblocks = self.flushed
+        del self.blocks[nblocks:]
+        self.handle.seek(self.coffset)
+        self.handle.truncate()
+
+    def close(self):
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer.clear()
+        while self.pending:
+            self.write_next()
+        self.pool.shutdown()
+        self.handle.write(BGZF_EOF)
+        self.handle.close()
+        if self.gzi_path is not None:
+            write_gzi(self.gzi_path, self.blocks)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def iter_bgzf_blocks(path: Path):
+    """Yield (compressed offset, uncompressed offset, size) per BGZF block.
+
+    Only each block's header and ISIZE footer are read; nothing is inflated.
+    """
+    with open(path, "rb", buffering=0) as f:
+        end = os.fstat(f.fileno()).st_size
+        coffset = uoffset = 0
+        while coffset < end:
+            block = read_bgzf_block(f, coffset, end)
+            if block is None:
+                raise ValueError(f"{path}: not a complete BGZF block at offset {coffset}")
+            bsize, isize = block
+            yield coffset, uoffset, isize
+            coffset += bsize
+            uoffset += isize
+
+def read_bgzf_block(f, coffset, end):
+    """Return (BSIZE, ISIZE) of the block at coffset in f, or None if it is not a complete BGZF block."""
+    f.seek(coffset)
+    header = f.read(18)
+    if len(header) < 18 or header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+        return None
+    bsize = struct.unpack_from("<H", header, 16)[0] + 1
+    if bsize < len(BGZF_EOF) or coffset + bsize > end:
+        return None
+    f.seek(coffset + bsize - 4)
+    return bsize, struct.unpack("<I", f.read(4))[0]
+
+def truncate_torn_bgzf(path: Path):
+    """Cut path back to its last complete BGZF block, e.g. after a crash mid-write."""
+    with open(path, "r+b", buffering=0) as f:
+        end = os.fstat(f.fileno()).st_size
+        coffset = 0
+        while coffset < end and (block := read_bgzf_block(f, coffset, end)) is not None:
+            coffset += block[0]
+        if coffset == end:
+            return
+        if coffset == 0:
+            raise ValueError(f"{path} exists but is not BGZF; refusing to append to it (use --reset)")
+        f.truncate(coffset)
+    print(f"[WARN] Dropped {end - coffset} bytes of incomplete BGZF data from the end of {path}")
+
+def truncate_to_checkpoint(path: Path, size: int):
+    """Cut path back to the size recorded at the last checkpoint, dropping genomes that never completed."""
+    end = path.stat().st_size
+    if end < size:
+        raise ValueError(f"{path} is {end} bytes but the checkpoint recorded {size}; it was modified since (use --reset)")
+    if end == size:
+        return
+    os.truncate(path, size)
+    print(f"[WARN] Dropped {end - size} bytes written after the last checkpoint from the end of {path}")
+
+def write_gzi(gzi_path: Path, blocks):
+    """Write a bgzip .gzi index from (compressed offset, uncompressed offset, size) blocks."""
+    # Like htslib, skip the implicit first block at 0/0 and empty (EOF marker) blocks
+    entries = [(c, u) for c, u, isize in blocks if c > 0 and isize > 0]
+    with open(gzi_path, "wb") as f:
+        f.write(struct.pack("<Q", len(entries)))
+        f.write(b"".join(struct.pack("<QQ", c, u) for c, u in entries))
+    print(f"[WRITE] BGZF index saved: {gzi_path}")
+
+class BgzipPipe:
+    """Stream into an external bgzip process; used when isal is not installed.
+
+    A pipe cannot be flushed through bgzip, so flush() ends the current bgzip
+    and the next write starts a new one. BGZF streams concatenate validly, so
+    each one (and a resumed run) simply appends blocks to the output.
+    """
+
+    def __init__(self, output_path: Path, threads=DEFAULT_THREADS, compresslevel=1, append=False):
+        self.output_path = output_path
+        self.cmd = ["bgzip", "-@", str(threads), "-l", str(compresslevel), "-c"]
+        self.mode = "ab" if append else "wb"
+        self.proc = None
+        self.flushed_size = output_path.stat().st_size if append else 0
+
+    def write(self, data):
+        if self.proc is None:
+            with open(self.output_path, self.mode) as out_file:
+                self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=out_file, bufsize=IO_BUFFER_SIZE)
+            self.mode = "ab"
+        self.proc.stdin.write(data)
+
+    def flush(self):
+        """Finish the running bgzip and fsync what it wrote."""
+        if self.proc is None:
+            return
+        proc, self.proc = self.proc, None
+        proc.stdin.close()
+        returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, proc.args)
+        with open(self.output_path, "rb") as out_file:
+            os.fsync(out_file.fileno())
+        self.flushed_size = self.output_path.stat().st_size
+
+    def rollback(self):
+        """Stop the running bgzip and truncate the output back to the last flush()."""
+        if self.proc is not None:
+            proc, self.proc = self.proc, None
+            proc.kill()
+            proc.wait()
+            with suppress(BrokenPipeError):  # unwritten buffer has nowhere to go
+                proc.stdin.close()
+        if self.output_path.exists():
+            os.truncate(self.output_path, self.flushed_size)
+
+    def close(self):
+        self.flush()
+        if self.flushed_size == 0:  # nothing written: still leave a valid, empty BGZF file
+            with open(self.output_path, "wb") as out_file:
+                out_file.write(BGZF_EOF)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_bgzf_output(output_path: Path, threads=DEFAULT_THREADS, compresslevel=1, append=False, gzi_path: Path = None):
+    """Open a BGZF writer: in-process ISA-L if available, else a bgzip pipe.
+
+    gzi_path is only honoured by the in-process writer, which records block
+    offsets as it writes them.
+    """
+    if isal_zlib is not None:
+        return BgzfWriter(output_path, threads=threads, compresslevel=compresslevel, append=append, gzi_path=gzi_path)
+    return BgzipPipe(output_path, threads=threads, compresslevel=compresslevel, append=append)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -112,39 +779,55 @@ if __name__ == "__main__":
     parser.add_argument("output_fasta", help="Final output file (must end with .fasta.gz)")
     parser.add_argument("scaffold_map_dir", help="Directory to save scaffold name mapping .txt files")
     parser.add_argument("--haplo_id", default="1", help="Haplotype ID to embed in headers (default: 1)")
-    parser.add_argument("--threads", type=int, default=4, help="Threads to use for bgzip (default: 4)")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS,
+                        help=f"Threads to use for BGZF compression, shared between workers (default: min(4, CPUs) = {DEFAULT_THREADS})")
+    parser.add_argument("--compresslevel", type=int, default=1, choices=range(0, 10), metavar="{0-9}",
+                        help="BGZF compression level; 1 is much faster than bgzip's default 6 for a few percent larger output (default: 1)")
+    parser.add_argument("--with-gzi", action="store_true", help="Also write a bgzip .gzi index (<output>.gzi) for random access")
+    parser.add_argument("--workers", type=int, default=1, help="Genomes to process in parallel; >1 writes per-genome shards (default: 1)")
     parser.add_argument("--checkpoint", type=Path, help="Path to checkpoint file (defaults to <output>.ckpt)")
     parser.add_argument("--error_log", type=Path, help="Path to error log file (defaults to <output>.errors.log)")
-    parser.add_argument("--reset", action="store_true", help="Ignore existing checkpoint and start fresh (overwrites temp output)")
+    parser.add_argument("--max_bad_checkpoint_lines", type=int, default=5,
+                        help="Abort if the checkpoint has more malformed lines than this (default: 5)")
+    parser.add_argument("--reset", action="store_true", help="Ignore existing checkpoint and start fresh (overwrites output)")
     args = parser.parse_args()
 
     output_path = Path(args.output_fasta)
     if output_path.suffix != ".gz":
         raise ValueError("Output file must end with '.gz' for bgzip compression.")
 
-    temp_path = output_path.with_suffix('')  # uncompressed temp (same name without .gz)
     ckpt_path = args.checkpoint or (output_path.parent / (output_path.name + ".ckpt"))
     errlog_path = args.error_log or (output_path.parent / (output_path.name + ".errors.log"))
+    gzi_path = output_path.parent / (output_path.name + ".gzi")
+    if not args.with_gzi and gzi_path.exists():
+        # The output is about to change, so an old index would point at the wrong blocks
+        gzi_path.unlink()
+        print(f"[INFO] Removed stale BGZF index: {gzi_path}")
 
     if args.reset:
         if ckpt_path.exists():
             ckpt_path.unlink()
-        if temp_path.exists():
-            temp_path.unlink()
-        print("[INFO] Reset requested: removed existing checkpoint and temp output.")
+        if output_path.exists():
+            output_path.unlink()
+        print("[INFO] Reset requested: removed existing checkpoint and output.")
 
     genome_entries = read_genome_list(args.genome_list)
-    failures = rewrite_headers_and_concat_with_checkpoints(
-        genome_entries,
-        temp_output=temp_path,
-        scaffold_map_dir=Path(args.scaffold_map_dir),
-        ckpt_path=ckpt_path,
-        errlog_path=errlog_path,
-        haplo_id=args.haplo_id
-    )
-
     # Compress even if there were failures—your pipeline may still want partial results.
-    bgzip_file(temp_path, threads=args.threads)
+    with ErrorLog(errlog_path) as errlog:
+        failures = rewrite_headers_and_concat_with_checkpoints(
+            genome_entries,
+            output_path=output_path,
+            scaffold_map_dir=Path(args.scaffold_map_dir),
+            ckpt_path=ckpt_path,
+            errlog=errlog,
+            haplo_id=args.haplo_id,
+            threads=args.threads,
+            compresslevel=args.compresslevel,
+            workers=args.workers,
+            gzi_path=gzi_path if args.with_gzi else None,
+            max_bad_checkpoint_lines=args.max_bad_checkpoint_lines
+        )
+    print(f"[DONE] Compressed to: {output_path}")
 
     if failures > 0:
         print(f"[DONE] Completed with {failures} failures. See log: {errlog_path}")
@@ -13,10 +13,10 @@ echo "Creating virtual environment in: $VENV_DIR"
 python3 -m venv "$VENV_DIR"
 source "$VENV_DIR/bin/activate"
 
-# STEP 2: Upgrade pip and install biopython
-echo "Installing biopython..."
+# STEP 2: Upgrade pip and install isal (in-process BGZF compression)
+echo "Installing isal..."
 pip install --upgrade pip
-pip install biopython
+pip install isal
 
 # STEP 3: Install htslib from source (for bgzip)
 echo "Installing HTSlib $HTSLIB_VERSION..."